@@ -1,45 +1,36 @@
 import numpy as np
-import scipy as sp
-import importlib
-import seaborn as sns
-import matplotlib.pyplot as plt
 import sys
-import pdb
 
 import omp
 
-N = 1e6
+N = int(1e6)
 ns = [5, 10, 20, 40, 100]
 m_mult = 10
 
-n = int(sys.argv[1])
+# n can be given as a single value or a comma separated list, e.g. 5,10,20
+if len(sys.argv) > 1:
+    ns = [int(n) for n in sys.argv[1].split(',')]
 if len(sys.argv) > 2:
     N = int(sys.argv[2])
 if len(sys.argv) > 3:
     m_mult = int(sys.argv[3])
 
-m = m_mult * n
-Vn = omp.make_sin_basis(n)
+# The sin bases are nested, so we compute the dictionary cross grammian once
+# for the largest n, and column slice it for all the smaller n
+Vn = omp.make_sin_basis(max(ns))
 
-dictionary = omp.make_unif_dictionary(N)
-rand_dictionary = omp.make_rand_dictionary(N)
+dictionaries = {'unif': omp.make_unif_dictionary(N), 'rand': omp.make_rand_dictionary(N)}
 
-gbc = omp.GreedyBasisConstructor(m, dictionary, Vn, verbose=True)
-Wm_omp = gbc.construct_basis()
+for dict_type, dictionary in dictionaries.items():
 
-# Save the omp points
-omp_x = [vec.params[0][0] for vec in Wm_omp.vecs]
-np.save('omp_x_unif_{0}_{1}'.format(n, N), omp_x)
+    dots = omp.dictionary_cross_grammian(dictionary, Vn)
 
-Wm_omp = Wm_omp.orthonormalise()
-
-gbc = omp.GreedyBasisConstructor(m, rand_dictionary, Vn, verbose=True)
-Wm_omp = gbc.construct_basis()
-
-# Save the omp points
-omp_x = [vec.params[0][0] for vec in Wm_omp.vecs]
-np.save('omp_x_rand_{0}_{1}'.format(n, N), omp_x)
-
-Wm_omp = Wm_omp.orthonormalise()
+    for n in ns:
+        m = m_mult * n
 
+        gbc = omp.GreedyBasisConstructor(m, dictionary, omp.make_sin_basis(n), verbose=True, dots=dots[:, :n])
+        Wm_omp = gbc.construct_basis()
 
+        # Save the omp points
+        omp_x = [vec.params[0][0] for vec in Wm_omp.vecs]
+        np.save('omp_x_{0}_{1}_{2}'.format(dict_type, n, N), omp_x)
@@ -6,26 +6,79 @@ Start date: April 2017
 
 Some code to test various orthogonal-matching pursuit (OMP) algorithms in 1 dimension. 
 Possibly will extend to 2 dimensions at some point.
+
+Can be run headless for a single greedy construction, see python -m omp --help
 """
 
 import math
 import numpy as np
 import scipy as sp
-from scipy.misc import factorial
+import scipy.linalg
+import scipy.sparse
 import collections
+import importlib.util
 
-from itertools import *
-import inspect
+from itertools import compress
 import copy
 import time
 
-import pdb
+# The number of points from which sin_evaluate uses sin_table rather than np.sin
+sin_table_min_points = 1000
 
 def sin_evaluate(x, m):
     # nb we allow both freq and x to be np arrays
     # returns an array of size len(x) * len(m)
+    m = np.atleast_1d(m)
+    # If there are many points, the frequencies are integers and most of 1..max(m) are needed,
+    # the recurrence is much cheaper than evaluating sin for every pair. For a few points
+    # (e.g. a single element dot) the loop over frequencies costs more than it saves
+    if np.size(x) >= sin_table_min_points and len(m) > 1 and m.max() <= 4 * len(m) \
+            and np.all(m == np.round(m)) and m.min() >= 1:
+        return sin_table(np.ravel(x), int(m.max()))[:, m.astype(int) - 1] * sin_norm(m)
     return np.sin(math.pi * np.outer(x, m)) * sin_norm(m)
 
+def sin_table(x, K):
+    """ The len(x) x K table of sin(k pi x) for k = 1..K from one sin/cos pair per point, using the
+        recurrence sin((k+1)t) = 2 cos(t) sin(kt) - sin((k-1)t). We use Reinsch's form of it, which
+        stays accurate when t is near 0 or pi, where the plain recurrence loses precision """
+    t = 0.5 * math.pi * np.asarray(x, dtype=np.float64)
+    sh, ch = np.sin(t), np.cos(t)
+
+    # Near t = 0 we recur on d_k = s_k - s_{k-1}, near t = pi on d_k = s_k + s_{k-1}
+    sgn = np.where(ch >= sh, 1.0, -1.0)
+    a = np.where(ch >= sh, -4.0 * sh * sh, 4.0 * ch * ch)
+
+    # Built one frequency per row so that each step of the recurrence writes contiguous memory
+    table = np.empty((K, len(t)))
+    if K == 0:
+        return table.T
+    table[0] = 2.0 * sh * ch
+    d = table[0].copy()
+    for k in range(1, K):
+        d *= sgn
+        d += a * table[k-1]
+        np.multiply(sgn, table[k-1], out=table[k])
+        table[k] += d
+    return table.T
+
+class SinTable(object):
+    """ A cache of sin(k pi x) at a fixed set of points x, such as a dictionary, that is
+        extended when higher frequencies are asked for """
+
+    def __init__(self, x, K=0):
+        self.x = x
+        self.table = sin_table(x, K)
+
+    def evaluate(self, m):
+        # Same as sin_evaluate(self.x, m), which we fall back to if m are not all positive integers
+        m = np.atleast_1d(m)
+        if not (np.all(m == np.round(m)) and m.min() >= 1):
+            return sin_evaluate(self.x, m)
+        K = int(m.max())
+        if K > self.table.shape[1]:
+            self.table = sin_table(self.x, max(K, 2 * self.table.shape[1]))
+        return self.table[:, m.astype(int) - 1] * sin_norm(m)
+
 def sin_norm(m):
     return math.sqrt(2.0) / (math.pi * m)
 
@@ -47,6 +100,14 @@ def del_evaluate(x, x0):
 def del_norm(x0):
     return 1. / np.sqrt((1. - x0) * x0)
 
+def del_sum_evaluate(x, x0, c):
+    # sum_k c_k omega_{x0_k}(x), which is piecewise linear with knots at the x0, so we
+    # evaluate it at the knots and interpolate, rather than form the len(x) * len(x0) matrix
+    order = np.argsort(x0)
+    knots = np.concatenate(([0.], x0[order], [1.]))
+    vals = np.concatenate(([0.], (del_evaluate(x0, x0) @ c)[order], [0.]))
+    return np.interp(x, knots, vals)
+
 def poly_evaluate(x, k):
     # Normaliser - yes the H1_0 norm of x (x - 1) x^k
     return (x[:,np.newaxis]**(k+1) - x[:,np.newaxis]**(k+2)) * poly_norm(k)
@@ -55,67 +116,419 @@ def poly_norm(k):
     #return np.sqrt( (2.*k+1.) * (2.*k+3.) / (8.*k*k*k + 32.*k*k + 39.*k + 13.) )
     return 1. / np.sqrt( (k+1.)*(k+1.) / (2.*k+1.) + 2.*(k+2.)*(k+1.) / (2.*k+2.) + (k+2.)*(k+2.) / (2.*k+3.) )
 
+def hat_centre_width(p):
+    # H1hat params are heap indices p = 2^l + i, for the hat centred at i / 2^l with
+    # half width 2^-l, so that hats of all the dyadic levels sort and merge like any other params
+    p = np.asarray(p, dtype=np.float64)
+    l = np.floor(np.log2(p))
+    h = 2.0 ** -l
+    return (p - 2.0 ** l) * h, h
+
+def hat_value(x, c, h):
+    # The hat normalised in H1_0, i.e. || hat' ||_L2 = 1
+    return np.maximum(0.0, 1.0 - np.abs(x - c) / h) * np.sqrt(0.5 * h)
+
+def hat_evaluate(x, p):
+    c, h = hat_centre_width(p)
+    return hat_value(np.atleast_1d(x)[:, np.newaxis], c, h)
+
+def hat_dot(p, evaluate):
+    # <hat, v> = - int hat'' v, and hat'' is a sum of 3 deltas, so the inner product of a hat with
+    # anything in H1_0 is the second difference of it at the hat nodes. evaluate(x) must return v(x)
+    # for an array of points x, broadcasting against the params p
+    c, h = hat_centre_width(p)
+    return (2.0 * evaluate(c) - evaluate(c - h) - evaluate(c + h)) * np.sqrt(0.5 * h) / h
+
 def sin_poly_integral(m, k):
-    # Integral from 0 to 1 of x^k sin(m pi x)
-    # As usual done in the most horribly numpy way possible
-    # The solution is a series that I've calculated...
-    
-    # add the new axis as we're making a 3D matrix which we later sum down
-    l = np.arange(0,(k[-1]+1)//2)[:,np.newaxis,np.newaxis]
-    m = m[:,np.newaxis]
-    
-    s = factorial(k) / factorial(k-2*l-1)
-    s[np.isinf(s)] = 0.0
+    # Integral from 0 to 1 of x^k sin(m pi x), as a len(m) x len(k) array,
+    # looked up from a table that is extended as needed
+    return sin_poly_integrals(m, k)
+
+def cos_poly_integral(m, k):
+    # Integral from 0 to 1 of x^k cos(m pi x), which is what the H1 inner product of H1sin
+    # and H1poly needs. Integrating by parts this is -k / (m pi) times the sin integral of x^(k-1)
+    m = np.atleast_1d(m)
+    k = np.atleast_1d(k)
+    return np.where(k > 0, -k / (m[:, np.newaxis] * math.pi) * sin_poly_integral(m, np.maximum(k - 1, 0)), 0.0)
+
+def sin_poly_table(M, K):
+    """ The M x K table of the integral from 0 to 1 of x^k sin(m pi x) for m = 1..M, k = 0..K-1.
+        Integrating by parts twice gives, with a = m pi,
+            S_k = (-1)^(m+1) / a - k (k-1) / a^2 S_{k-2}
+        which is stable run forwards while k < a, and run backwards when k > a, so we do both
+        and take each entry from the stable direction """
+
+    a = math.pi * np.arange(1, M+1)[:, np.newaxis]
+    c = -(-1.0) ** np.arange(1, M+1)[:, np.newaxis] / a
+    k = np.arange(K)
+
+    forward = np.zeros((M, K))
+    with np.errstate(over='ignore', invalid='ignore'):
+        forward[:, 0:1] = (1.0 - np.cos(a)) / a
+        if K > 1:
+            forward[:, 1:2] = c
+        for j in range(2, K):
+            forward[:, j:j+1] = c - j * (j - 1) / (a * a) * forward[:, j-2:j-1]
+
+    # Start the backward recurrence far enough up that the error in the starting values,
+    # S_k ~ (-1)^(m+1) a / ((k+1)(k+2)), has been damped away by the time it reaches K. Only the
+    # rows with a <= k are run, as below a the backward recurrence grows (and overflows for large m)
+    top = 2 * K + 40
+    backward = np.zeros((M, top + 2))
+    backward[:, top:top+2] = c * a * a / ((np.arange(top, top+2) + 1.) * (np.arange(top, top+2) + 2.))
+    for j in range(top + 1, 1, -1):
+        r = np.searchsorted(a[:, 0], j - 2, side='right')
+        if r == 0:
+            break
+        backward[:r, j-2:j-1] = (c[:r] - backward[:r, j:j+1]) * (a[:r] * a[:r]) / (j * (j - 1))
+
+    return np.where(k < a, forward, backward[:, :K])
+
+class SinPolyIntegrals(object):
+    """ A cache of sin_poly_table, which grows (by doubling) in m or k when larger ones are asked for """
+
+    def __init__(self):
+        self.table = np.zeros((0, 0))
+
+    def __call__(self, m, k):
+        m = np.atleast_1d(m).astype(int)
+        k = np.atleast_1d(k).astype(int)
+        M, K = self.table.shape
+        if m.max() > M or k.max() >= K:
+            # Only grow the dimensions that need it
+            if m.max() > M:
+                M = max(m.max(), 2 * M)
+            if k.max() >= K:
+                K = max(k.max() + 1, 2 * K)
+            self.table = sin_poly_table(M, K)
+        return self.table[np.ix_(m - 1, k)]
+
+sin_poly_integrals = SinPolyIntegrals()
 
-    d = -1.0 / (m * m * math.pi * math.pi)
-   
-    full = (-1)** m * s * (-d ** (l+1))
-    
-    # now add that last little bit
-    twid = factorial(k)
-    twid[k % 2 == 0] = 0.0 # Even ones set to 0
+"""
+*****************************************************************************************
+The kernel registry. Each element type has an integer code and an evaluation function, and
+each pair of types has a kernel giving the matrix of inner products between elements of
+unit coefficient. A kernel can also carry a compiled "fused" loop that does the full
+weighted sum without building the matrix, used when the numba backend is selected. numba
+is only imported when the fused loops are first compiled.
+*****************************************************************************************
+"""
 
-    twid = twid * (-d**((k+1)//2))
-    
-    return full.sum(axis=0) - twid
+fn_type_codes = {}
+evaluators = []
+kernels = {}
+kernel_backend = 'numpy'
+
+class Kernel(object):
+
+    def __init__(self, matrix, fused=None):
+        # matrix(lp, rp) returns the len(lp) x len(rp) matrix of inner products
+        # fused(lp, lc, rp, rc) returns lc @ matrix(lp, rp) @ rc, and may assume that lp and rp
+        # are sorted ascending (as Vector keeps them), dot_element sorts them if they aren't
+        self.matrix = matrix
+        self.fused = fused
+        self.compiled = None
+        # For a transposed kernel, the kernel it is the transpose of
+        self.parent = None
+
+    def compile(self):
+        """ The numba compiled fused loop, or None if there isn't one """
+        if self.compiled is None and self.parent is not None:
+            f = self.parent.compile()
+            if f is not None:
+                self.compiled = lambda lp, lc, rp, rc: f(rp, rc, lp, lc)
+        elif self.compiled is None and self.fused is not None:
+            import numba
+            self.compiled = numba.njit(cache=True)(self.fused)
+        return self.compiled
+
+    def transpose(self):
+        kernel = Kernel(lambda lp, rp: self.matrix(rp, lp).T)
+        kernel.parent = self
+        return kernel
+
+def register_fn_type(fn_type, evaluate):
+    """ Add a new element type, where evaluate(x, params) returns a len(x) x len(params) array """
+    if fn_type not in fn_type_codes:
+        fn_type_codes[fn_type] = len(evaluators)
+        evaluators.append(evaluate)
+    else:
+        evaluators[fn_type_codes[fn_type]] = evaluate
+    return fn_type_codes[fn_type]
+
+def register_kernel(lt, rt, matrix, fused=None):
+    """ Add the kernel for the pair of types. The (rt, lt) kernel is registered as the transpose.
+        The fused loop, if given, may assume its params are sorted, see Kernel """
+    kernel = Kernel(matrix, fused)
+    kernels[fn_type_codes[lt], fn_type_codes[rt]] = kernel
+    if lt != rt:
+        kernels[fn_type_codes[rt], fn_type_codes[lt]] = kernel.transpose()
+
+def set_kernel_backend(backend):
+    """ Either 'numpy' for the reference implementations, or 'numba' for the compiled fused loops """
+    global kernel_backend
+    if backend not in ['numpy', 'numba']:
+        raise Exception('Unknown kernel backend {0}'.format(backend))
+    if backend == 'numba' and importlib.util.find_spec('numba') is None:
+        raise Exception('numba is not installed, can not use numba kernel backend')
+    kernel_backend = backend
+
+def sorted_params(p, c):
+    # The params and coeffs as float arrays sorted by param, which the fused loops rely on
+    p = np.asarray(p, dtype=np.float64)
+    c = np.asarray(c, dtype=np.float64)
+    if np.any(p[1:] < p[:-1]):
+        s = np.argsort(p)
+        return p[s], c[s]
+    return p, c
 
 def dot_element(lt, lp, lc, rt, rp, rc):
+    kernel = kernels[fn_type_codes[lt], fn_type_codes[rt]]
+    if kernel_backend == 'numba' and kernel.compile() is not None:
+        return kernel.compiled(*sorted_params(lp, lc), *sorted_params(rp, rc))
+    return lc @ kernel.matrix(lp, rp) @ rc
+
+def kernel_conformance(size=10, seed=0):
+    """ Checks the compiled fused kernels, as called by dot_element, against the numpy reference
+        implementations on random elements, returning the relative difference for each pair of types
+        and each of the cases: sorted params, unsorted params, and non-integer sin frequencies """
+    if importlib.util.find_spec('numba') is None:
+        raise Exception('numba is not installed, no compiled kernels to check')
+
+    global kernel_backend
+    backend = kernel_backend
+    kernel_backend = 'numba'
+
+    rng = np.random.RandomState(seed)
+    sorted_case = {'H1sin': np.arange(1, size+1).astype(np.float64),
+                   'H1delta': np.sort(rng.random_sample(size)),
+                   'H1poly': np.arange(size).astype(np.float64)}
+    cases = {'sorted': sorted_case,
+             'unsorted': {t: rng.permutation(p) for t, p in sorted_case.items()},
+             'non-integer': dict(sorted_case, H1sin=np.sort(rng.uniform(0.5, size, size)))}
+
+    diffs = {}
+    try:
+        for case, params in cases.items():
+            for (lt, rt) in [(lt, rt) for lt in fn_type_codes for rt in fn_type_codes]:
+                if lt not in params or rt not in params:
+                    continue
+                lc = rng.standard_normal(size)
+                rc = rng.standard_normal(size)
+                kernel = kernels[fn_type_codes[lt], fn_type_codes[rt]]
+                if kernel.compile() is not None:
+                    ref = lc @ kernel.matrix(params[lt], params[rt]) @ rc
+                    fused = dot_element(lt, params[lt], lc, rt, params[rt], rc)
+                    diffs[lt, rt, case] = abs(fused - ref) / max(abs(ref), 1e-300)
+    finally:
+        kernel_backend = backend
+    return diffs
+
+def del_sin_matrix(lp, rp):
+    return del_norm(lp)[:,np.newaxis] * sin_evaluate(lp, rp)
+
+def del_del_matrix(lp, rp):
+    return del_norm(lp)[:,np.newaxis] * del_evaluate(lp, rp)
+
+def del_poly_matrix(lp, rp):
+    return del_norm(lp)[:,np.newaxis] * poly_evaluate(lp, rp)
+
+def sin_sin_matrix(lp, rp):
+    return np.equal.outer(lp, rp).astype(np.float64)
+
+def sin_poly_matrix(lp, rp):
+    return poly_norm(rp) * sin_norm(lp[:,np.newaxis]) \
+           * ((rp + 1) * (lp[:,np.newaxis] * math.pi) * cos_poly_integral(lp, rp) \
+           - (rp + 2) * (lp[:,np.newaxis] * math.pi) * cos_poly_integral(lp, rp+1))
+
+def poly_poly_matrix(lp, rp):
+    l = lp[:, np.newaxis]
+    k = rp
+    return poly_norm(l) * poly_norm(k) * ((l + 1) * (k + 1) / (l + k + 1) \
+           + ((l + 1) * (k + 2) + (l + 2) * (k + 1)) / (l + k + 2) \
+           + (l + 2) * (k + 2) / (l + k + 3))
+
+def hat_matrix(evaluate):
+    # The kernel of H1hat with the type that evaluate (one of the evaluators) belongs to
+    return lambda lp, rp: hat_dot(lp[:, np.newaxis], lambda x: evaluate(np.ravel(x), rp).reshape(x.shape[0], len(rp)))
+
+def del_sin_fused(lp, lc, rp, rc):
+    # The frequencies rp are sorted, so for integer frequencies we step through
+    # sin(k pi x) with the same recurrence as sin_table
     dot = 0.0
-    if lt == 'H1delta':
-        n = del_norm(lp) #1.0 / np.sqrt(lp * (1.0 - lp))
-        if rt == 'H1sin':
-            dot += (n[:,np.newaxis] * lc[:,np.newaxis] * rc * sin_evaluate(x = lp, m = rp)).sum()
-        elif rt == 'H1delta':
-            dot += (n[:,np.newaxis] * lc[:,np.newaxis] * rc * del_evaluate(x = lp, x0 = rp)).sum()
-        elif rt == 'H1poly':
-            dot +=  (n[:,np.newaxis] * lc[:,np.newaxis] * rc * poly_evaluate(x = lp, m = rp)).sum()
-    elif lt == 'H1sin':
-        if rt == 'H1sin':
-            dot += (lc[:,np.newaxis] * rc * np.equal.outer(lp, rp)).sum()
-        elif rt == 'H1delta':
-            n = del_norm(rp) #1.0 / np.sqrt(rp * (1.0 - rp))
-            dot += (n[:, np.newaxis] * lc * rc[:, np.newaxis] * sin_evaluate(x = rp, m = lp)).sum()
-        elif rt == 'H1poly':
-            dot += (lc[:,np.newaxis] * rc * poly_norm(rp) * sin_norm(lp[:,np.newaxis]) \
-                  * ((rp + 1) * (lp[:,np.newaxis] * math.pi) * sin_poly_integral(lp, rp) \
-                  - (rp + 2) * (lp[:, np.newaxis] * math.pi) * sin_poly_integral(lp, rp+1))).sum()
-    elif lt == 'H1poly':
-        if rt == 'H1sin':
-            dot += (lc * rc[:,np.newaxis] * poly_norm(lp) * sin_norm(rp[:,np.newaxis]) \
-                   * ((lp + 1) * (rp[:,np.newaxis] * math.pi) * sin_poly_integral(rp, lp) \
-                   - (lp + 2) * (rp[:,np.newaxis] * math.pi) * sin_poly_integral(rp, lp+1))).sum()
-        elif rt == 'H1delta':
-            n = del_norm(rp) #1.0 / np.sqrt(rp * (1.0 - rp))
-            dot += (n[:, np.newaxis] * lc * rc[:, np.newaxis] * poly_evaluate(x = rp, m = lp)).sum()
-        elif rt == 'H1poly':
-            l = lp[:, np.newaxis]
-            k = rp
-            dot += (poly_norm(l) * poly_norm(k) * lc[:, np.newaxis] * rc * ((l + 1) * (k + 1) / (l + k + 1) \
-                   + ((l + 1) * (k + 2) + (l + 2) * (k + 1)) / (l + k + 2) \
-                   + (l + 2) * (k + 2) / (l + k + 3))).sum()
+    for i in range(lp.shape[0]):
+        w = lc[i] / math.sqrt((1. - lp[i]) * lp[i])
+        sh = math.sin(0.5 * math.pi * lp[i])
+        ch = math.cos(0.5 * math.pi * lp[i])
+        if ch >= sh:
+            sgn, a = 1.0, -4.0 * sh * sh
+        else:
+            sgn, a = -1.0, 4.0 * ch * ch
+        k = 1
+        s = d = 2.0 * sh * ch
+        for j in range(rp.shape[0]):
+            if rp[j] != math.floor(rp[j]) or rp[j] < 1:
+                v = math.sin(math.pi * lp[i] * rp[j])
+            else:
+                while k < rp[j]:
+                    d = sgn * d + a * s
+                    s = d + sgn * s
+                    k += 1
+                v = s
+            dot += w * rc[j] * math.sqrt(2.0) / (math.pi * rp[j]) * v
+    return dot
 
+def del_del_fused(lp, lc, rp, rc):
+    dot = 0.0
+    for i in range(lp.shape[0]):
+        w = lc[i] / math.sqrt((1. - lp[i]) * lp[i])
+        for j in range(rp.shape[0]):
+            if lp[i] < rp[j]:
+                v = lp[i] * (1. - rp[j])
+            else:
+                v = (1. - lp[i]) * rp[j]
+            dot += w * rc[j] * v / math.sqrt((1. - rp[j]) * rp[j])
     return dot
 
+def sin_sin_fused(lp, lc, rp, rc):
+    # Both lots of params are sorted, so we can merge rather than compare all pairs
+    dot = 0.0
+    i = j = 0
+    while i < lp.shape[0] and j < rp.shape[0]:
+        if lp[i] < rp[j]:
+            i += 1
+        elif lp[i] > rp[j]:
+            j += 1
+        else:
+            dot += lc[i] * rc[j]
+            i += 1
+            j += 1
+    return dot
+
+register_fn_type('H1sin', sin_evaluate)
+register_fn_type('H1delta', del_evaluate)
+register_fn_type('H1poly', poly_evaluate)
+
+register_kernel('H1delta', 'H1sin', del_sin_matrix, del_sin_fused)
+register_kernel('H1delta', 'H1delta', del_del_matrix, del_del_fused)
+register_kernel('H1delta', 'H1poly', del_poly_matrix)
+register_kernel('H1sin', 'H1sin', sin_sin_matrix, sin_sin_fused)
+register_kernel('H1sin', 'H1poly', sin_poly_matrix)
+register_kernel('H1poly', 'H1poly', poly_poly_matrix)
+
+def hat_hat_matrix(lp, rp):
+    """ The hat by hat kernel as a sparse matrix, as hats only have non-zero inner
+        products with the hats whose supports overlap their own """
+    l_centre, l_h = hat_centre_width(lp)
+    r_centre, r_h = hat_centre_width(rp)
+
+    # The candidates for each left hat are the right hats that start less than 2 max(r_h)
+    # before it starts, and before it ends, which we then filter down to those that overlap
+    order = np.argsort(r_centre - r_h, kind='stable')
+    r_left = (r_centre - r_h)[order]
+    lo = np.searchsorted(r_left, l_centre - l_h - 2.0 * r_h.max(), side='right')
+    hi = np.searchsorted(r_left, l_centre + l_h, side='left')
+    counts = np.maximum(hi - lo, 0)
+
+    i = np.repeat(np.arange(len(lp)), counts)
+    j = order[np.repeat(lo, counts) + np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)]
+    overlap = r_centre[j] + r_h[j] > l_centre[i] - l_h[i]
+    i, j = i[overlap], j[overlap]
+
+    # <hat_i, hat_j> as the second difference of hat_j at the nodes of hat_i
+    vals = hat_dot(lp[i], lambda x: hat_value(x, r_centre[j], r_h[j]))
+    return sp.sparse.csr_matrix((vals, (i, j)), shape=(len(lp), len(rp)))
+
+def hat_grammian(p, c):
+    """ The Grammian of single hat elements with params p and coefficients c, as a sparse matrix """
+    C = sp.sparse.diags(c)
+    return (C @ hat_hat_matrix(p, p) @ C).tocsr()
+
+register_fn_type('H1hat', hat_evaluate)
+for fn_type in ['H1sin', 'H1delta', 'H1poly']:
+    register_kernel('H1hat', fn_type, hat_matrix(evaluators[fn_type_codes[fn_type]]))
+register_kernel('H1hat', 'H1hat', hat_hat_matrix)
+
+"""
+*****************************************************************************************
+2D tensor product elements, in the tensor product space H1_0 x H1_0, where the inner
+product of u1 x u2 and v1 x v2 is <u1, v1> <u2, v2>, so all the kernels are products of
+the 1D kernels. The params of the 2D types are complex numbers, x + 1j * y for points and
+m1 + 1j * m2 for frequencies, so that they sort and merge like the 1D params.
+*****************************************************************************************
+"""
+
+def sin2_evaluate(x, m):
+    x = np.atleast_1d(x)
+    m = np.atleast_1d(m)
+    return sin_evaluate(x.real, m.real) * sin_evaluate(x.imag, m.imag)
+
+def del2_evaluate(x, x0):
+    x = np.atleast_1d(x)
+    x0 = np.atleast_1d(x0)
+    return del_evaluate(x.real, x0.real) * del_evaluate(x.imag, x0.imag)
+
+def del2_norm(x0):
+    return del_norm(x0.real) * del_norm(x0.imag)
+
+def del2_sum_evaluate(x, x0, c):
+    # sum_k c_k omega_{x0_k}(x) in 2D. Each term is a product of 1D hats, so the sum is bilinear
+    # on each cell of the grid of the knot coordinates. As in del_sum_evaluate we evaluate it on
+    # that grid, O(len(x0)^3), and interpolate, rather than form the len(x) * len(x0) matrices
+    gx = np.unique(np.concatenate(([0.], x0.real, [1.])))
+    gy = np.unique(np.concatenate(([0.], x0.imag, [1.])))
+    vals = (del_evaluate(gx, x0.real) * c) @ del_evaluate(gy, x0.imag).T
+
+    xr = np.ravel(x.real)
+    xi = np.ravel(x.imag)
+    ix = np.clip(np.searchsorted(gx, xr, side='right') - 1, 0, len(gx) - 2)
+    iy = np.clip(np.searchsorted(gy, xi, side='right') - 1, 0, len(gy) - 2)
+    tx = (xr - gx[ix]) / (gx[ix+1] - gx[ix])
+    ty = (xi - gy[iy]) / (gy[iy+1] - gy[iy])
+
+    val = (1. - ty) * ((1. - tx) * vals[ix, iy] + tx * vals[ix+1, iy]) \
+          + ty * ((1. - tx) * vals[ix, iy+1] + tx * vals[ix+1, iy+1])
+    return val.reshape(np.shape(x))
+
+def tensor_matrix(matrix):
+    # The 2D kernel from the 1D kernel, evaluated on all pairs at once in each dimension
+    return lambda lp, rp: matrix(lp.real, rp.real) * matrix(lp.imag, rp.imag)
+
+class SinTable2(object):
+    """ The 2D version of SinTable, a table for each coordinate of the points x """
+
+    def __init__(self, x, K1=0, K2=0):
+        self.tables = (SinTable(x.real, K1), SinTable(x.imag, K2))
+
+    def evaluate(self, m):
+        m = np.atleast_1d(m)
+        return self.tables[0].evaluate(m.real) * self.tables[1].evaluate(m.imag)
+
+register_fn_type('H1sin2', sin2_evaluate)
+register_fn_type('H1delta2', del2_evaluate)
+
+register_kernel('H1delta2', 'H1sin2', tensor_matrix(del_sin_matrix))
+register_kernel('H1delta2', 'H1delta2', tensor_matrix(del_del_matrix))
+register_kernel('H1sin2', 'H1sin2', tensor_matrix(sin_sin_matrix))
+
+def banded(G):
+    """ The lower banded storage of a sparse symmetric matrix, ab[i - j, j] = G[i, j],
+        as used by the scipy banded Cholesky and solvers """
+    G = G.tocoo()
+    lower = G.row >= G.col
+    ab = np.zeros((int((G.row - G.col)[lower].max()) + 1, G.shape[0]))
+    ab[G.row[lower] - G.col[lower], G.col[lower]] = G.data[lower]
+    return ab
+
+def unbanded(ab):
+    """ The dense lower triangular matrix from its lower banded storage """
+    n = ab.shape[1]
+    L = np.zeros((n, n))
+    for d in range(ab.shape[0]):
+        L[np.arange(d, n), np.arange(n - d)] = ab[d, :n - d]
+    return L
+
 # Define a basis as a collection of elements
 
 # Write the dictionary and Basis class, and basis pair class, in terms of these elements
@@ -166,15 +579,18 @@ class Vector(object):
     def norm(self):
         return math.sqrt(self.dot(self))
 
-    def evaluate(self, x):
+    def evaluate(self, x, sin_table=None):
+        # sin_table is an optional SinTable (or SinTable2 for 2D) for the points x, shared between evaluations
         val = np.zeros(x.shape)
         for fn_i, fn_type in enumerate(self.fn_types):
-            if fn_type == 'H1sin':
-                val += (self.coeffs[fn_i] * sin_evaluate(x, self.params[fn_i])).sum(axis=-1)
-            if fn_type == 'H1delta':
-                val += (self.coeffs[fn_i] * del_evaluate(x, self.params[fn_i])).sum(axis=-1)
-            if fn_type == 'H1poly':
-                val += (self.coeffs[fn_i] * poly_evaluate(x, self.params[fn_i])).sum(axis=-1)
+            if sin_table is not None and fn_type in ['H1sin', 'H1sin2']:
+                val += (self.coeffs[fn_i] * sin_table.evaluate(self.params[fn_i])).sum(axis=-1)
+            elif fn_type == 'H1delta' and np.size(x) > len(self.params[fn_i]):
+                val += del_sum_evaluate(x, self.params[fn_i], self.coeffs[fn_i])
+            elif fn_type == 'H1delta2' and np.size(x) > len(self.params[fn_i]):
+                val += del2_sum_evaluate(x, self.params[fn_i], self.coeffs[fn_i])
+            else:
+                val += (self.coeffs[fn_i] * evaluators[fn_type_codes[fn_type]](x, self.params[fn_i])).sum(axis=-1)
         return val
 
 
@@ -266,6 +682,7 @@ class Basis(object):
 
         self.orthonormal_basis = None
         self.G = None
+        self.L = None
         self.U = self.S = self.V = None
 
     def add_vector(self, vec):
@@ -274,19 +691,49 @@ class Basis(object):
         self.vecs.append(vec)
         self.n += 1
 
-        if self.G is not None:
+        if self.G is not None and sp.sparse.issparse(self.G):
+            g = sp.sparse.csr_matrix(np.array([[self.vecs[-1].dot(v) for v in self.vecs]]))
+            self.G = sp.sparse.bmat([[self.G, g[:, :-1].T], [g[:, :-1], g[:, -1:]]]).tocsr()
+        elif self.G is not None:
             self.G = np.pad(self.G, ((0,1),(0,1)), 'constant')
             for i in range(self.n):
                 self.G[self.n-1, i] = self.G[i, self.n-1] = self.vecs[-1].dot(self.vecs[i])
 
+        self.L = None
         self.U = self.V = self.S = None
 
     def subspace(self, indices):
         """ To be able to do "nested" spaces, the easiest way is to implement
             subspaces such that we can draw from a larger ambient space """
-        sub = type(self)(self.vecs[indices])
+        if isinstance(indices, slice):
+            start, stop, step = indices.indices(self.n)
+            if start == 0 and step == 1:
+                return self.prefix(stop)
+
+            sub = type(self)(self.vecs[indices])
+            if self.G is not None:
+                sub.G = self.G[indices, indices]
+            return sub
+
+        indices = np.asarray(indices)
+        sub = type(self)([self.vecs[i] for i in indices])
         if self.G is not None:
-            sub.G = self.G[indices, indices]
+            sub.G = self.G[np.ix_(indices, indices)]
+        return sub
+
+    def prefix(self, k):
+        """ The subspace of the first k vectors. As the Grammian, its Cholesky factor and the
+            orthonormal basis are all nested, the subspace is a cheap view that shares them """
+        sub = type(self)(self.vecs[:k])
+        if self.G is not None:
+            sub.G = self.G[:k, :k]
+        if self.L is not None and sp.sparse.issparse(self.G):
+            # In banded storage the leading block is just the first k columns
+            sub.L = self.L[:, :k]
+        elif self.L is not None:
+            sub.L = self.L[:k, :k]
+        if self.orthonormal_basis is not None:
+            sub.orthonormal_basis = self.orthonormal_basis.prefix(k)
         return sub
 
     def subspace_mask(self, mask):
@@ -308,6 +755,12 @@ class Basis(object):
 
     def make_grammian(self):
         if self.G is None:
+            # Hat functions are local, so their Grammian is sparse (and banded if they are in order)
+            hats = single_elements(self.vecs, 'H1hat')
+            if hats is not None:
+                self.G = hat_grammian(*hats)
+                return
+
             self.G = np.zeros([self.n,self.n])
             for i in range(self.n):
                 for j in range(i+1):
@@ -333,19 +786,24 @@ class Basis(object):
             u_n = self.dot(u)
             try:
                 if sp.sparse.issparse(self.G):
-                    y_n = sp.sparse.linalg.spsolve(self.G, u_n)
+                    y_n = sp.linalg.cho_solve_banded((self.cholesky(), True), u_n)
+                elif self.L is not None:
+                    y_n = sp.linalg.cho_solve((self.L, True), u_n)
                 else:
-                    y_n = sp.linalg.solve(self.G, u_n, sym_pos=True)
+                    y_n = sp.linalg.solve(self.G, u_n, assume_a='pos')
             except np.linalg.LinAlgError as e:
                 print('Warning - basis is linearly dependent with {0} vectors, projecting using SVD'.format(self.n))
 
                 if self.U is None:
-                    if sp.sparse.issparse(self.G):
-                        self.U, self.S, self.V =  sp.sparse.linalg.svds(self.G)
-                    else:
-                        self.U, self.S, self.V = np.linalg.svd(self.G)
-                # This is the projection on the reduced rank basis 
-                y_n = self.V.T @ ((self.U.T @ u_n) / self.S)
+                    # A full SVD, even if the grammian is sparse, as we need every singular value
+                    G = self.G.toarray() if sp.sparse.issparse(self.G) else self.G
+                    self.U, self.S, self.V = np.linalg.svd(G)
+                # This is the projection on the reduced rank basis, ignoring the directions
+                # with (numerically) zero singular values
+                S_inv = np.zeros_like(self.S)
+                nonzero = self.S > self.S[0] * len(self.S) * np.finfo(float).eps
+                S_inv[nonzero] = 1.0 / self.S[nonzero]
+                y_n = self.V.T @ ((self.U.T @ u_n) * S_inv)
 
             # We allow the projection to be of the same type 
             # Also create it from the simple broadcast and sum (which surely should
@@ -362,9 +820,18 @@ class Basis(object):
         if len(c) != len(self.vecs):
             raise Exception('Coefficients and vectors must be of same length!')
          
+        # Gather all the elements of each type and merge them in one go, rather
+        # than adding the vectors one at a time
+        params = collections.OrderedDict()
+        coeffs = collections.OrderedDict()
+        for c_i, vec in zip(c, self.vecs):
+            for p, v_c, fn_type in zip(vec.params, vec.coeffs, vec.fn_types):
+                params.setdefault(fn_type, []).append(p)
+                coeffs.setdefault(fn_type, []).append(c_i * v_c)
+
         u_p = Vector()
-        for i, c_i in enumerate(c):
-            u_p += c_i * self.vecs[i] 
+        for fn_type in params:
+            u_p.merge_type(np.concatenate(params[fn_type]), np.concatenate(coeffs[fn_type]), fn_type)
         return u_p
 
     def matrix_multiply(self, M):
@@ -393,19 +860,36 @@ class Basis(object):
         # In case this is an orthonormal basis
         return type(self)(vecs)
 
+    def cholesky(self):
+        """ The lower triangular Cholesky factor of the Grammian, which is kept so that
+            prefix subspaces can share it. For a sparse Grammian it is in lower banded storage """
+        if self.L is None:
+            if self.G is None:
+                self.make_grammian()
+
+            if sp.sparse.issparse(self.G):
+                self.L = sp.linalg.cholesky_banded(banded(self.G), lower=True)
+            else:
+                self.L = np.linalg.cholesky(self.G)
+        return self.L
+
+    def cholesky_solve_lower(self, M):
+        """ L^{-1} M, where L is the Cholesky factor of the Grammian """
+        L = self.cholesky()
+        if sp.sparse.issparse(self.G):
+            return sp.linalg.solve_banded((L.shape[0] - 1, 0), L, M)
+        return sp.linalg.solve_triangular(L, M, lower=True)
+
     def orthonormalise(self):
 
-        if self.G is None:
-            self.make_grammian()
-        
         # We do a cholesky factorisation rather than a Gram Schmidt, as
         # we have a symmetric +ve definite matrix, so this is a cheap and
         # easy way to get an orthonormal basis from our previous basis
         
+        L = self.cholesky()
         if sp.sparse.issparse(self.G):
-            L = sp.sparse.cholmod.cholesky(self.G)
-        else:
-            L = np.linalg.cholesky(self.G)
+            # The orthonormal basis is dense whatever the Grammian is
+            L = unbanded(L)
         L_inv = sp.linalg.lapack.dtrtri(L.T)[0]
          
         ortho_vecs = []
@@ -488,12 +972,43 @@ class BasisPair(object):
 
         self.U = self.V = self.S = None
 
+    def prefix(self, k):
+        """ The pair of the first k vectors of Wm with Vn, a view that shares the cross grammian """
+        return BasisPair(self.Wm.prefix(k), self.Vn, CG=self.CG[:k])
+
+    def subspace(self, indices):
+        """ The pair of a subspace of Wm with Vn, see Basis.subspace """
+        if not isinstance(indices, slice):
+            indices = np.asarray(indices)
+        return BasisPair(self.Wm.subspace(indices), self.Vn, CG=self.CG[indices])
+
     def beta(self):
         if self.U is None or self.S is None or self.V is None:
             self.calc_svd()
 
         return self.S[-1]
 
+    def beta_curve(self):
+        """ Calculates beta(Vn, W_k) for every prefix W_k of Wm in one incremental pass, so that
+            b[k-1] = self.prefix(k).beta() (when Wm and Vn are orthonormal). If either basis is
+            not orthonormal we use its Cholesky factor rather than orthonormalising it """
+
+        M = self.CG
+        # The prefixes of Wm L^{-T} are orthonormal bases of the prefixes of Wm
+        if not isinstance(self.Wm, OrthonormalBasis):
+            M = self.Wm.cholesky_solve_lower(M)
+        if not isinstance(self.Vn, OrthonormalBasis):
+            M = self.Vn.cholesky_solve_lower(M.T).T
+
+        # The singular values of M[:k] are those of its R factor, which we update a row at a time
+        b = np.zeros(self.m)
+        R = np.zeros((0, self.n))
+        for k in range(self.m):
+            R = np.linalg.qr(np.vstack((R, M[k])), mode='r')
+            b[k] = sp.linalg.svdvals(R)[-1]
+
+        return b
+
     def calc_svd(self):
         if self.U is None or self.S is None or self.V is None:
             self.U, self.S, self.V = np.linalg.svd(self.CG)
@@ -521,7 +1036,7 @@ class BasisPair(object):
     def optimal_reconstruction(self, w, disp_cond=False):
         """ And here it is - the optimal reconstruction """
         try:
-            c = scipy.linalg.solve(self.CG.T @ self.CG, self.CG.T @ w, sym_pos=True)
+            c = sp.linalg.solve(self.CG.T @ self.CG, self.CG.T @ w, assume_a='pos')
         except np.linalg.LinAlgError as e:
             print('Warning - unstable v* calculation, m={0}, n={1} for Wm and Vn, returning 0 function'.format(self.Wm.n, self.Vn.n))
             c = np.zeros(self.Vn.n)
@@ -590,6 +1105,12 @@ def make_sin_basis(n):
     return OrthonormalBasis(V_n)
 
 
+def make_hat_basis(level):
+    """ The 2^level - 1 hat functions on the uniform mesh of width 2^-level, in order
+        of position, so that the Grammian is tridiagonal """
+    vecs = [Vector([2**level + i], [1.0], ['H1hat']) for i in range(1, 2**level)]
+    return Basis(vecs)
+
 def make_random_delta_basis(n, bounds=None, bound_prop=1.0):
 
     vecs = []
@@ -641,12 +1162,100 @@ def make_rand_dictionary(N):
 
     return dic
 
+def make_sin2_basis(n):
+    """ The first n of the 2D tensor product sines, ordered as (1,1), (1,2), (2,1), (2,2), (1,3), ... """
+    V_n = []
+
+    k = int(math.ceil(math.sqrt(n)))
+    freqs = sorted([(i, j) for i in range(1, k+1) for j in range(1, k+1)], key=lambda f: (max(f), f))
+    for i, j in freqs[:n]:
+        V_n.append(Vector([complex(i, j)], [1.0], ['H1sin2']))
+
+    return OrthonormalBasis(V_n)
+
+def make_unif_dictionary_2d(N):
+    """ Point evaluations on the k x k grid of interior points of the unit square, with
+        k = round(sqrt(N)), so that like the other dictionaries it has (about) N elements """
+
+    k = int(round(math.sqrt(N)))
+    points = np.linspace(0.0, 1.0, k+1, endpoint=False)[1:]
+    x, y = np.meshgrid(points, points, indexing='ij')
+
+    dic = [Vector([p],[1.0],['H1delta2']) for p in (x + 1j * y).ravel()]
+
+    return dic
+
+def make_rand_dictionary_2d(N):
+
+    points = np.random.random(N) + 1j * np.random.random(N)
+
+    dic = [Vector([p],[1.0],['H1delta2']) for p in points]
+
+    return dic
+
+def single_elements(vecs, fn_type):
+    """ If every vector is a single element of type fn_type, return the arrays
+        of params and coefficients, otherwise return None """
+
+    if not all(len(v.fn_types) == 1 and v.fn_types[0] == fn_type and len(v.params[0]) == 1 for v in vecs):
+        return None
+
+    params = np.array([v.params[0][0] for v in vecs])
+    coeffs = np.array([v.coeffs[0][0] for v in vecs])
+    return params, coeffs
+
+def dictionary_points(dictionary):
+    """ If every element of the dictionary is a single point evaluation, return the
+        arrays of points and coefficients, otherwise return None. 2D points are complex """
+    return single_elements(dictionary, 'H1delta') or single_elements(dictionary, 'H1delta2')
+
+def dictionary_dots(dictionary, v, points=None, sin_table=None):
+    """ The inner products <d_j, v> for every d_j in the dictionary. For point evaluation
+        dictionaries (as given by dictionary_points) we use the fact that
+        <v, omega_x> = v(x) / || delta_x ||, and simply evaluate v at all the points """
+
+    if points is not None:
+        x, c = points
+        if np.iscomplexobj(x):
+            return c * del2_norm(x) * v.evaluate(x, sin_table)
+        return c * del_norm(x) * v.evaluate(x, sin_table)
+
+    return np.array([d.dot(v) for d in dictionary])
+
+def dictionary_cross_grammian(dictionary, Vn, points=None):
+    """ The N x n matrix of inner products between the dictionary and Vn. As make_sin_basis
+        spaces are nested, this can be computed once for the largest n and then column
+        sliced for all the smaller ones """
+
+    if points is None:
+        points = dictionary_points(dictionary)
+
+    # The sin evaluations at the dictionary points are shared by all the vectors of Vn
+    sin_table = None
+    if points is not None and np.iscomplexobj(points[0]):
+        freqs = np.concatenate([p for v in Vn.vecs for t, p in zip(v.fn_types, v.params) if t == 'H1sin2'] + [np.zeros(1)])
+        sin_table = SinTable2(points[0], int(freqs.real.max()), int(freqs.imag.max()))
+    elif points is not None:
+        K = max([int(p.max()) for v in Vn.vecs for t, p in zip(v.fn_types, v.params) if t == 'H1sin'] + [0])
+        sin_table = SinTable(points[0], K)
+
+    # Filled a row at a time and returned transposed, so that each row is written contiguously
+    CG = np.zeros([Vn.n, len(dictionary)])
+    for j, phi in enumerate(Vn.vecs):
+        CG[j] = dictionary_dots(dictionary, phi, points, sin_table)
+    return CG.T
+
 class GreedyBasisConstructor(object):
     """ Probably should rename this class, but it implements the Collective OMP algorithm for constructing Wm """
 
-    def __init__(self, m, dictionary, Vn, verbose=False, remove=True):
+    def __init__(self, m, dictionary, Vn, verbose=False, remove=True, dots=None, scan_dtype=None, rescore=8):
         """ We need to be either given a dictionary or a point generator that produces d-dimensional points
-            from which we generate the dictionary. """
+            from which we generate the dictionary. Optionally dots is the (N x n) cross grammian of the
+            dictionary with Vn (see dictionary_cross_grammian), which may be shared between several
+            constructors, in which case the selection is done with matrix operations alone.
+
+            If scan_dtype is given (e.g. np.float32) the dictionary is scored in that precision, and the
+            best rescore candidates are then scored again in double precision to make the choice. """
             
         self.dictionary = copy.copy(dictionary)
 
@@ -658,14 +1267,45 @@ class GreedyBasisConstructor(object):
         self.greedy_basis = None
         self.sel_crit = np.zeros(m)
 
+        self.scan_dtype = scan_dtype
+        self.rescore = rescore
+        if self.scan_dtype is not None and dots is None:
+            dots = dictionary_cross_grammian(self.dictionary, self.Vn)
+
+        self.dots = dots
+        self.residual = None
+        if self.dots is not None:
+            if self.dots.shape != (len(self.dictionary), self.Vn.n):
+                raise Exception('Cross grammian must be of size {0}x{1}'.format(len(self.dictionary), self.Vn.n))
+
+            self.points = dictionary_points(self.dictionary)
+            # The dots of the chosen elements with Vn, and the coefficients of the orthonormalised
+            # chosen elements q_k in terms of the chosen elements (upper triangular)
+            self.Wm_dots = np.zeros([m, self.Vn.n])
+            self.Q = np.zeros([m, m])
+            # The residuals <phi_i - P_Wm phi_i, d_j>, which get a rank one update as each element
+            # is chosen. This is a copy, as dots may be shared with other constructors
+            self.residual = np.array(self.dots, dtype=self.scan_dtype or np.float64)
+            if self.scan_dtype is not None:
+                # The exact dots of the chosen elements are recomputed in double precision, so we
+                # don't keep the full precision cross grammian alive next to its reduced copy
+                self.dots = None
+            # Chosen elements are masked out rather than deleted, so the dictionary is left alone
+            self.available = np.ones(len(self.dictionary), dtype=bool)
+
     def initial_choice(self):
         """ Different greedy methods will have their own maximising/minimising criteria, so all 
         inheritors of this class are expected to overwrite this method to suit their needs. """
     
-        norms = np.zeros(len(self.dictionary))
-        for i in range(len(self.dictionary)):
-            for phi in self.Vn.vecs:
-                norms[i] += phi.dot(self.dictionary[i]) ** 2
+        if self.residual is not None:
+            norms = (self.residual ** 2).sum(axis=1)
+            if self.scan_dtype is not None:
+                return self.rescore_choice(norms)
+        else:
+            norms = np.zeros(len(self.dictionary))
+            for i in range(len(self.dictionary)):
+                for phi in self.Vn.vecs:
+                    norms[i] += phi.dot(self.dictionary[i]) ** 2
 
         n0 = np.argmax(norms)
 
@@ -675,15 +1315,24 @@ class GreedyBasisConstructor(object):
         """ Different greedy methods will have their own maximising/minimising criteria, so all 
         inheritors of this class are expected to overwrite this method to suit their needs. """
 
-        proj_t = 0.0
-        dot_t = 0.0
-        next_crit = np.zeros(len(self.dictionary))
-        # We go through the dictionary and find the max of || f ||^2 - || P_Vn f ||^2
-        for phi in self.Vn.vecs:
-            phi_perp = phi - self.greedy_basis.project(phi)
-            for j in range(len(self.dictionary)):
-                next_crit[j] += phi_perp.dot(self.dictionary[j]) ** 2
-                #p_V_d[i] = self.greedy_basis.project(self.dictionary[i]).norm()
+        if self.residual is not None:
+            next_crit = (self.residual ** 2).sum(axis=1)
+            next_crit[~self.available] = -np.inf
+            if self.scan_dtype is not None:
+                # c = G^{-1} <phi, w_k>, so that P_Wm phi = sum_k c_k w_k
+                C = sp.linalg.solve(self.greedy_basis.G, self.Wm_dots[:i], assume_a='pos')
+                ni, crit = self.rescore_choice(next_crit, C)
+                if self.verbose:
+                    print('{0} : \t {1}'.format(i, crit))
+                return ni, crit
+        else:
+            next_crit = np.zeros(len(self.dictionary))
+            # We go through the dictionary and find the max of || f ||^2 - || P_Vn f ||^2
+            for phi in self.Vn.vecs:
+                phi_perp = phi - self.greedy_basis.project(phi)
+                for j in range(len(self.dictionary)):
+                    next_crit[j] += phi_perp.dot(self.dictionary[j]) ** 2
+                    #p_V_d[i] = self.greedy_basis.project(self.dictionary[i]).norm()
         
         ni = np.argmax(next_crit)
 
@@ -692,6 +1341,52 @@ class GreedyBasisConstructor(object):
 
         return ni, next_crit[ni]
 
+    def rescore_choice(self, crit, C=None):
+        """ Takes the best few candidates of a reduced precision scan and scores them again in double
+            precision, that is || P_Vn d_j ||^2 or, given C = G^{-1} <phi, w_k>, || P_Vn (d_j - P_Wm d_j) ||^2 """
+
+        k = min(self.rescore, len(crit))
+        candidates = np.argpartition(crit, -k)[-k:]
+
+        exact = np.zeros(k)
+        for c_i, j in enumerate(candidates):
+            d_j = np.array([phi.dot(self.dictionary[j]) for phi in self.Vn.vecs])
+            if C is not None:
+                d_j -= np.array([w.dot(self.dictionary[j]) for w in self.greedy_basis.vecs]) @ C
+            exact[c_i] = (d_j ** 2).sum()
+
+        best = np.argmax(exact)
+        return candidates[best], exact[best]
+
+    def update_dots(self, ni, i):
+        """ Update the residuals once dictionary element w = d_ni is chosen as the i-th element of Wm.
+            With q = (w - P_Wm w) / || w - P_Wm w || the new orthonormal direction, P_Wm phi gains
+            <phi, q> q, so the residuals lose <phi_i, q> <q, d_j> """
+
+        w = self.dictionary[ni]
+        if self.scan_dtype is not None:
+            # The projections are done in double precision, so we need the exact dots of the chosen element
+            self.Wm_dots[i] = [phi.dot(w) for phi in self.Vn.vecs]
+        else:
+            self.Wm_dots[i] = self.dots[ni]
+
+        # Gram-Schmidt on the grammian, q = (w - sum_k <q_k, w> q_k) / norm
+        g = self.greedy_basis.G[:i+1, i]
+        proj = self.Q[:i, :i].T @ g[:i]
+        norm = math.sqrt(max(g[i] - proj @ proj, 0.0))
+        if norm == 0.0:
+            raise Exception('Chosen dictionary element {0} is already in Wm'.format(ni))
+        self.Q[:i, i] = -(self.Q[:i, :i] @ proj) / norm
+        self.Q[i, i] = 1.0 / norm
+
+        q = self.greedy_basis.reconstruct(self.Q[:i+1, i])
+        q_dots = dictionary_dots(self.dictionary, q, self.points)
+        phi_dots = self.Q[:i+1, i] @ self.Wm_dots[:i+1]
+        self.residual -= np.outer(q_dots, phi_dots).astype(self.residual.dtype, copy=False)
+
+        if self.remove:
+            self.available[ni] = False
+
     def construct_basis(self):
         " The construction method should be generic enough to support all variants of the greedy algorithms """
         
@@ -701,7 +1396,9 @@ class GreedyBasisConstructor(object):
             self.greedy_basis = Basis([self.dictionary[n0]])
             self.greedy_basis.make_grammian()
  
-            if self.remove:
+            if self.residual is not None:
+                self.update_dots(n0, 0)
+            elif self.remove:
                 del self.dictionary[n0]
 
             if self.verbose:
@@ -714,7 +1411,9 @@ class GreedyBasisConstructor(object):
                    
                 self.greedy_basis.add_vector(self.dictionary[ni])
  
-                if self.remove:
+                if self.residual is not None:
+                    self.update_dots(ni, i)
+                elif self.remove:
                     del self.dictionary[ni]
                        
             if self.verbose:
@@ -830,3 +1529,83 @@ class WorstVecOMP(GreedyBasisConstructor):
 
         return ni, next_crit[ni]
 
+
+"""
+*****************************************************************************************
+Running a single greedy construction, either from another script (e.g. sweep.py) or
+headless from the command line with python -m omp
+*****************************************************************************************
+"""
+
+dictionary_makers = {'unif': make_unif_dictionary, 'rand': make_rand_dictionary,
+                     'unif2d': make_unif_dictionary_2d,
+                     'rand2d': make_rand_dictionary_2d}
+
+def run_greedy(constructor, n, m, N, dictionary, seed, verbose=False):
+    """ Builds the dictionary and Vn, runs the named greedy constructor and returns the chosen
+        points, the selection criteria, the beta curve and the timings of each stage """
+
+    np.random.seed(seed)
+
+    timings = {}
+    t0 = time.time()
+    if dictionary not in dictionary_makers:
+        raise Exception('Unknown dictionary type {0}'.format(dictionary))
+    dic = dictionary_makers[dictionary](N)
+
+    Vn = make_sin2_basis(n) if dictionary.endswith('2d') else make_sin_basis(n)
+    timings['dictionary'] = time.time() - t0
+
+    t0 = time.time()
+    cons = globals()[constructor]
+    if cons is GreedyBasisConstructor:
+        gbc = cons(m, dic, Vn, verbose=verbose, dots=dictionary_cross_grammian(dic, Vn))
+    else:
+        gbc = cons(m, dic, Vn, verbose=verbose)
+    Wm = gbc.construct_basis()
+    timings['construct'] = time.time() - t0
+
+    t0 = time.time()
+    beta = BasisPair(Wm, Vn).beta_curve()
+    timings['beta'] = time.time() - t0
+
+    return {'points': np.array([vec.params[0][0] for vec in Wm.vecs]),
+            'sel_crit': gbc.sel_crit,
+            'beta': beta,
+            'timings': timings}
+
+def main(argv=None):
+    import argparse
+
+    t0 = time.time()
+    parser = argparse.ArgumentParser(prog='python -m omp', description='Run one greedy construction of Wm for Vn')
+    parser.add_argument('-c', '--constructor', default='GreedyBasisConstructor',
+                        choices=['GreedyBasisConstructor', 'WorstCaseOMP', 'WorstVecOMP'])
+    parser.add_argument('-n', type=int, default=20, help='dimension of Vn')
+    parser.add_argument('-m', type=int, default=None, help='dimension of Wm (default 10 n)')
+    parser.add_argument('-N', type=int, default=int(1e4), help='size of the dictionary')
+    parser.add_argument('-d', '--dictionary', default='unif', choices=sorted(dictionary_makers))
+    parser.add_argument('-s', '--seed', type=int, default=0)
+    parser.add_argument('-o', '--output', default=None,
+                        help='npz file for the results (default omp_x_<dictionary>_<n>_<N>.npz)')
+    parser.add_argument('-v', '--verbose', action='store_true')
+    args = parser.parse_args(argv)
+
+    m = args.m if args.m is not None else 10 * args.n
+    output = args.output or 'omp_x_{0}_{1}_{2}.npz'.format(args.dictionary, args.n, args.N)
+
+    result = run_greedy(args.constructor, args.n, m, args.N, args.dictionary, args.seed, args.verbose)
+    np.savez(output, points=result['points'], sel_crit=result['sel_crit'], beta=result['beta'])
+
+    print('Wrote {0}, beta = {1:.6}'.format(output, result['beta'][-1]))
+    print('Timings: ' + ', '.join('{0} {1:.3f}s'.format(k, v) for k, v in result['timings'].items())
+          + ', total {0:.3f}s'.format(time.time() - t0))
+    try:
+        import resource
+        # ru_maxrss is in kilobytes on Linux
+        print('Peak memory: {0:.1f} MB'.format(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024))
+    except ImportError:
+        pass
+
+if __name__ == '__main__':
+    main()
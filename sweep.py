@@ -0,0 +1,161 @@
+"""
+sweep.py
+
+Runs a grid of greedy basis constructions over (constructor, n, m, N, dictionary, seed)
+on a process pool, storing the results on disk as one npz file per configuration,
+named by the hash of the configuration. Configurations already in the store are skipped,
+so a sweep can be stopped and restarted, or extended with new values.
+
+Usage: python sweep.py store_dir [ns] [Ns] [m_mult] [seeds]
+where the lists are comma separated, e.g. python sweep.py results 5,10,20 1000,10000 10 0,1
+"""
+
+import os
+import sys
+import json
+import hashlib
+import itertools
+import concurrent.futures
+
+import numpy as np
+
+import omp
+
+constructors = ['GreedyBasisConstructor', 'WorstCaseOMP', 'WorstVecOMP']
+dictionary_kinds = ['unif', 'rand']
+
+def make_grid(constructors=constructors, ns=[5, 10, 20, 40, 100], ms=None, m_mult=10, Ns=[int(1e4)],
+              dictionary_kinds=dictionary_kinds, seeds=[0]):
+    """ All combinations of the parameters as a list of config dicts. If ms is None then
+        we take m = m_mult * n for each n """
+
+    grid = []
+    for cons, n, N, kind, seed in itertools.product(constructors, ns, Ns, dictionary_kinds, seeds):
+        for m in (ms if ms is not None else [m_mult * n]):
+            grid.append({'constructor': cons, 'n': int(n), 'm': int(m), 'N': int(N),
+                         'dictionary': kind, 'seed': int(seed)})
+    return grid
+
+def config_hash(config):
+    return hashlib.sha1(json.dumps(config, sort_keys=True).encode()).hexdigest()[:16]
+
+def config_path(store, config):
+    return os.path.join(store, config_hash(config) + '.npz')
+
+def memory_estimate(config):
+    """ Rough number of bytes a run needs, dominated by the N x n dictionary cross grammian and
+        its residuals, and the dictionary itself """
+    N, n = config['N'], config['n']
+    if config['constructor'] == 'GreedyBasisConstructor':
+        return 16 * N * n + 1000 * N
+    return 1000 * N
+
+def available_memory():
+    try:
+        return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    except (ValueError, OSError, AttributeError):
+        return None
+
+def run_config(config):
+    """ Does the greedy construction for the one configuration, returns a dict of results """
+    return omp.run_greedy(config['constructor'], config['n'], config['m'], config['N'],
+                          config['dictionary'], config['seed'])
+
+def save_result(store, config, result):
+    path = config_path(store, config)
+    # Write to a temporary file first so that an interrupted sweep never leaves a partial result
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as f:
+        np.savez(f, config=json.dumps(config), points=result['points'], sel_crit=result['sel_crit'],
+                 beta=result['beta'], timings=json.dumps(result['timings']))
+    os.replace(tmp, path)
+
+def read_result(path):
+    with np.load(path) as f:
+        return {'config': json.loads(str(f['config'])),
+                'points': f['points'],
+                'sel_crit': f['sel_crit'],
+                'beta': f['beta'],
+                'timings': json.loads(str(f['timings']))}
+
+def load_result(store, config):
+    """ The stored result for the config, or None if it hasn't been run """
+    path = config_path(store, config)
+    if not os.path.exists(path):
+        return None
+    return read_result(path)
+
+def load_results(store):
+    """ All results in the store """
+    return [read_result(os.path.join(store, p)) for p in sorted(os.listdir(store)) if p.endswith('.npz')]
+
+def run_sweep(grid, store, workers=None, memory=None, verbose=True):
+    """ Runs every config in the grid that isn't already in the store. Jobs are started largest
+        first, and only while the estimated memory of the running jobs fits within memory bytes
+        (by default the currently available physical memory). Returns the configs that failed """
+
+    os.makedirs(store, exist_ok=True)
+
+    todo = [c for c in grid if not os.path.exists(config_path(store, c))]
+    todo.sort(key=memory_estimate, reverse=True)
+    if verbose:
+        print('{0} of {1} configs already done, running {2}'.format(len(grid) - len(todo), len(grid), len(todo)))
+
+    if workers is None:
+        workers = os.cpu_count() or 1
+    if memory is None:
+        memory = available_memory()
+
+    running = {}
+    failed = []
+    n_run = len(todo)
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+        while todo or running:
+            # Start the biggest job that fits, always allowing one job so that we can't stall
+            in_use = sum(memory_estimate(c) for c in running.values())
+            while todo and len(running) < workers:
+                fits = [c for c in todo if memory is None or not running or in_use + memory_estimate(c) <= memory]
+                if not fits:
+                    break
+                config = fits[0]
+                todo.remove(config)
+                running[pool.submit(run_config, config)] = config
+                in_use += memory_estimate(config)
+
+            done, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                config = running.pop(future)
+                # A failed config is reported and left out of the store, so that it is run again
+                # next time, rather than losing the other results that have finished
+                try:
+                    result = future.result()
+                except Exception as e:
+                    failed.append(config)
+                    print('Failed {0}: {1!r}'.format(config, e))
+                    continue
+                save_result(store, config, result)
+                if verbose:
+                    print('Done {0}'.format(config))
+
+    if failed:
+        print('{0} of {1} configs failed'.format(len(failed), n_run))
+    return failed
+
+if __name__ == '__main__':
+
+    store = sys.argv[1]
+    ns = [5, 10, 20, 40, 100]
+    Ns = [int(1e4)]
+    m_mult = 10
+    seeds = [0]
+
+    if len(sys.argv) > 2:
+        ns = [int(n) for n in sys.argv[2].split(',')]
+    if len(sys.argv) > 3:
+        Ns = [int(N) for N in sys.argv[3].split(',')]
+    if len(sys.argv) > 4:
+        m_mult = int(sys.argv[4])
+    if len(sys.argv) > 5:
+        seeds = [int(s) for s in sys.argv[5].split(',')]
+
+    run_sweep(make_grid(ns=ns, Ns=Ns, m_mult=m_mult, seeds=seeds), store)